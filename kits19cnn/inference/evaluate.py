@@ -100,7 +100,7 @@ class Evaluator(object):
         if self.file_ending == ".npy":
             label = np.load(y_path)
         elif self.file_ending == ".nii.gz" or self.file_ending == ".nii":
-            label = nib.load(y_path).get_fdata()
+            label = np.asanyarray(nib.load(y_path).dataobj).astype(np.uint8)
         pred = np.load(join(self.pred_dir, case, "pred.npy")).squeeze()
         if self.binary_tumor:
             # treating prediced 1s as tumor (2)
@@ -1,4 +1,5 @@
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join, isdir
 from tqdm import tqdm
 import os
@@ -16,7 +17,7 @@ class Predictor(object):
     """
     def __init__(self, out_dir, checkpoint_path, model,
                  test_loader, pred_3D_params={"do_mirroring": True},
-                 pseudo_3D: bool = False):
+                 pseudo_3D: bool = False, freeze_model: bool = False):
         """
         Attributes
             out_dir (str): path to the output directory to store predictions
@@ -28,6 +29,9 @@ class Predictor(object):
                 must have the __len__ arg.
             pred_3D_params (dict): kwargs for `model.predict_3D`
             pseudo_3D (bool): whether or not to have pseudo 3D inputs
+            freeze_model (bool): whether or not to predict with a TorchScript
+                traced and frozen copy of `model`. Only for tiled prediction
+                (fixed input shapes).
         """
         self.out_dir = out_dir
         if not isdir(self.out_dir):
@@ -36,6 +40,8 @@ class Predictor(object):
         assert inspect.ismethod(model.predict_3D), \
                 "model must have the method `predict_3D`"
         self.model = load_weights_infer(checkpoint_path, model)
+        if freeze_model:
+            self.model.freeze_for_inference()
         self.test_loader = test_loader
         self.pred_3D_params = pred_3D_params
         self.pseudo_3D = pseudo_3D
@@ -43,21 +49,33 @@ class Predictor(object):
     def run_3D_predictions(self):
         """
         Runs predictions on the dataset (specified in test_loader)
+
+        Loading is prefetched by the test_loader workers and saving is done
+        in a background thread, so the GPU keeps predicting while the
+        previous case is written to disk.
         """
         cases = self.test_loader.dataset.im_ids
         assert len(cases) == len(self.test_loader)
-        for (test_batch, case) in tqdm(zip(self.test_loader, cases), total=len(cases)):
-            test_x = torch.squeeze(test_batch[0], dim=0)
-            if self.pseudo_3D:
-                pred, _, act, _ = self.model.predict_3D_pseudo3D_2Dconv(test_x,
-                                                                    **self.pred_3D_params)
-            else:
-                pred, _, act, _ = self.model.predict_3D(test_x,
-                                                        **self.pred_3D_params)
-            assert len(pred.shape) == 3
-            assert len(act.shape) == 4
-            ### possible place to threshold ROI size ###
-            self.save_pred(pred, act, case)
+        save_future = None
+        with ThreadPoolExecutor(max_workers=1) as saver:
+            for (test_batch, case) in tqdm(zip(self.test_loader, cases), total=len(cases)):
+                test_x = torch.squeeze(test_batch[0], dim=0)
+                if self.pseudo_3D:
+                    pred, _, act, _ = self.model.predict_3D_pseudo3D_2Dconv(test_x,
+                                                                        **self.pred_3D_params)
+                else:
+                    pred, _, act, _ = self.model.predict_3D(test_x,
+                                                            **self.pred_3D_params)
+                assert len(pred.shape) == 3
+                assert len(act.shape) == 4
+                ### possible place to threshold ROI size ###
+                # at most one case is waiting to be saved at a time, which
+                # also re-raises any error from the previous save
+                if save_future is not None:
+                    save_future.result()
+                save_future = saver.submit(self.save_pred, pred, act, case)
+            if save_future is not None:
+                save_future.result()
 
     def save_pred(self, pred, act, case):
         """
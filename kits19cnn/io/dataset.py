@@ -49,6 +49,9 @@ class VoxelDataset(Dataset):
     def load_volume(self, case_id):
         """
         Loads volume from either .npy or nifti files.
+        .npy files are memory-mapped (copy-on-write), so only the parts that
+        the transforms actually touch (i.e. a crop) are read from disk and
+        in-place transforms never write back to the file.
         Args:
             case_id: path to the case folder
                 i.e. /content/kits19/data/case_00001
@@ -60,9 +63,11 @@ class VoxelDataset(Dataset):
         x_path = join(case_id, f"imaging{self.file_ending}")
         y_path = join(case_id, f"segmentation{self.file_ending}")
         if self.file_ending == ".npy":
-            x, y = np.load(x_path), np.load(y_path)
+            x = np.load(x_path, mmap_mode="c")
+            y = np.load(y_path, mmap_mode="c")
         elif self.file_ending == ".nii.gz" or self.file_ending == ".nii":
-            x, y = nib.load(x_path).get_fdata(), nib.load(y_path).get_fdata()
+            x = nib.load(x_path).get_fdata(dtype=np.float32)
+            y = np.asanyarray(nib.load(y_path).dataobj).astype(np.uint8)
         return (x[None], y[None])
 
 class ClfSegVoxelDataset(VoxelDataset):
@@ -177,9 +182,11 @@ class TestVoxelDataset(VoxelDataset):
         x_path = join(case_id, f"imaging{self.file_ending}")
         y_path = join(case_id, f"segmentation{self.file_ending}")
         if self.file_ending == ".npy":
-            x = np.load(x_path)
-            y = np.load(y_path) if isfile(y_path) else np.zeros(x.shape)
+            x = np.load(x_path, mmap_mode="c")
+            y = np.load(y_path, mmap_mode="c") if isfile(y_path) \
+                else np.zeros(x.shape)
         elif self.file_ending == ".nii.gz" or self.file_ending == ".nii":
-            x = nib.load(x_path).get_fdata()
-            y = nib.load(y_path).get_fdata() if isfile(y_path) else np.zeros(x.shape)
+            x = nib.load(x_path).get_fdata(dtype=np.float32)
+            y = np.asanyarray(nib.load(y_path).dataobj).astype(np.uint8) \
+                if isfile(y_path) else np.zeros(x.shape)
         return (x[None], y[None])
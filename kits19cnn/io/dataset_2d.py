@@ -1,7 +1,5 @@
-import os
 from os.path import join
 from pathlib import Path
-from glob import glob
 import numpy as np
 
 import torch
@@ -12,9 +10,9 @@ class SliceDataset(Dataset):
                  preprocessing=None, p_pos_per_sample: float = 0.33,
                  mode: str = "segmentation", num_classes: int = 3):
         """
-        Reads from a directory of 2D slice numpy arrays and samples positive
-        slices. Assumes the data directory contains 2D slices processed by
-        `io.Preprocessor.save_dir_as_2d()`.
+        Samples 2D slices (positive slices `p_pos_per_sample` of the time)
+        from the preprocessed 3D numpy arrays. Assumes the data directory was
+        processed by `io.Preprocessor.save_dir_as_2d()`.
         Attributes
             im_ids (np.ndarray): of image names.
             pos_slice_dict (dict): dictionary generated by
@@ -74,27 +72,48 @@ class SliceDataset(Dataset):
 
     def load_slices(self, case_fpath):
         """
-        Gets the slice idx using self.get_slice_idx_str() and actually loads
-        the appropriate slice array.
+        Gets the slice idx using self.get_slice_idx() and actually loads
+        the appropriate slice from the memory-mapped 3D arrays (only that
+        slice is read from disk).
         """
-        slice_idx_str = self.get_slice_idx_str(case_fpath)
-        x_path = join(case_fpath, f"imaging_{slice_idx_str}.npy")
-        y_path = join(case_fpath, f"segmentation_{slice_idx_str}.npy")
-        return (np.load(x_path)[None], np.load(y_path)[None])
+        x_vol, y_vol = self.load_volume_mmap(case_fpath)
+        slice_idx = self.get_slice_idx(case_fpath, x_vol.shape[1])
+        # copying, so that the slice is a regular writable array
+        return (np.array(x_vol[:, slice_idx])[None],
+                np.array(y_vol[:, slice_idx])[None])
 
-    def get_slice_idx_str(self, case_fpath):
+    def load_volume_mmap(self, case_fpath):
         """
-        Gets the slice idx and processes it so that it fits how the arrays
-        were saved by `io.Preprocessor.save_dir_as_2d`.
+        Memory-maps the preprocessed 3D arrays of a case.
+        Args:
+            case_fpath: each element of self.im_ids (path to a case folder)
+        Returns:
+            Tuple of:
+            - x (np.memmap): shape (n_channels, d, h, w)
+            - y (np.memmap): same shape as x
+        """
+        x_path = join(case_fpath, "imaging.npy")
+        y_path = join(case_fpath, "segmentation.npy")
+        x, y = np.load(x_path, mmap_mode="r"), np.load(y_path, mmap_mode="r")
+        # io.Preprocessor.gen_data saves (1, n_channels, d, h, w) arrays
+        x = x[0] if len(x.shape) == 5 else x
+        y = y[0] if len(y.shape) == 5 else y
+        return (x, y)
+
+    def get_slice_idx(self, case_fpath, num_slices):
+        """
+        Gets a random slice idx; a positive one `p_pos_per_sample` of the time.
+        Args:
+            case_fpath: each element of self.im_ids (path to a case folder)
+            num_slices (int): number of slices in the case
         """
         # extracting slice:
         temp_p = np.random.uniform(0, 1)
         if temp_p < self.p_pos_per_sample:
             slice_idx = self.get_rand_pos_slice_idx(case_fpath)
         else:
-            slice_idx = self.get_rand_slice_idx(case_fpath)
-        slice_idx_str = self._parse_slice_idx_to_str(slice_idx)
-        return slice_idx_str
+            slice_idx = self.get_rand_slice_idx(case_fpath, num_slices)
+        return slice_idx
 
     def get_rand_pos_slice_idx(self, case_fpath):
         """
@@ -115,17 +134,15 @@ class SliceDataset(Dataset):
             random_pos_coord = np.random.choice(self.pos_slice_dict[case_raw])
         return random_pos_coord
 
-    def get_rand_slice_idx(self, case_fpath):
+    def get_rand_slice_idx(self, case_fpath, num_slices):
         """
         Args:
             case_fpath: each element of self.im_ids (path to a case folder)
+            num_slices (int): number of slices in the case
         Returns:
             A randomly selected slice index
         """
-        # assumes that there are no other files in said directory with "imaging_"
-        _slice_files = [file for file in os.listdir(case_fpath)
-                        if file.startswith("imaging_")]
-        return np.random.randint(0, len(_slice_files))
+        return np.random.randint(0, num_slices)
 
     def check_fg_idx_per_class(self):
         """
@@ -154,25 +171,15 @@ class SliceDataset(Dataset):
         one_hot[unique] = 1
         return one_hot
 
-    def _parse_slice_idx_to_str(self, slice_idx):
-        """
-        Parse the slice index to a three digit string for reading the 2D .npy
-        files generated by io.preprocess.Preprocessor.
-        """
-        slice_idx_str = str(slice_idx)
-        while len(slice_idx_str) < 3:
-            slice_idx_str = "0"+slice_idx_str
-        return slice_idx_str
-
 class PseudoSliceDataset(SliceDataset):
     def __init__(self, im_ids: np.array, pos_slice_dict: dict, transforms=None,
                  preprocessing=None, p_pos_per_sample: float = 0.33,
                  mode: str = "segmentation", num_classes: int = 3,
                  num_pseudo_slices=1):
         """
-        Reads from a directory of 2D slice numpy arrays and samples positive
-        slices. Assumes the data directory contains 2D slices processed by
-        `io.Preprocessor.save_dir_as_2d()`.
+        Samples 2D slices (positive slices `p_pos_per_sample` of the time)
+        from the preprocessed 3D numpy arrays. Assumes the data directory was
+        processed by `io.Preprocessor.save_dir_as_2d()`.
         Attributes
             im_ids (np.ndarray): of image names.
             pos_slice_dict (dict): dictionary generated by
@@ -199,43 +206,26 @@ class PseudoSliceDataset(SliceDataset):
 
     def load_slices(self, case_fpath):
         """
-        Gets the slice idx using self.get_slice_idx_str() and actually loads
-        the appropriate slice array. Returned arrays have shape:
+        Gets the slice idx using self.get_slice_idx() and actually loads
+        the appropriate slices from the memory-mapped 3D arrays. Returned
+        arrays have shape:
             (batch_size, n_channels, h, w)
         for batchgenerators transforms.
         """
-        center_slice_idx_str, center_slice_idx = self.get_slice_idx_str(case_fpath)
-        total_num_slices = len(glob(join(case_fpath, "imaging_*.npy")))
-        min = center_slice_idx - (self.num_pseudo_slices - 1) // 2
-        max = center_slice_idx + (self.num_pseudo_slices - 1) // 2 + 1
-
-        x_path = join(case_fpath, f"imaging_{center_slice_idx_str}.npy")
-        y_path = join(case_fpath, f"segmentation_{center_slice_idx_str}.npy")
-        center_x, center_y = np.load(x_path)[None], np.load(y_path)[None]
+        x_vol, y_vol = self.load_volume_mmap(case_fpath)
+        center_slice_idx = self.get_slice_idx(case_fpath, x_vol.shape[1])
+        # copying, so that the slices are regular writable arrays
+        center_x = np.array(x_vol[:, center_slice_idx])[None]
+        center_y = np.array(y_vol[:, center_slice_idx])[None]
 
         if self.num_pseudo_slices == 1:
             return (center_x, center_y)
         elif self.num_pseudo_slices > 1:
             # total shape: (1, num_pseudo_slices, h, w)
             x_arr = np.zeros((1, self.num_pseudo_slices) + center_x.shape[2:])
-            for idx, slice_idx in enumerate(range(min, max)):
-                slice_idx_str = self._parse_slice_idx_to_str(slice_idx)
-                x_path = join(case_fpath, f"imaging_{slice_idx_str}.npy")
-                # loading slices if they exist
-                if os.path.isfile(x_path):
-                    x_arr[:, idx] = np.load(x_path)
+            first_idx = center_slice_idx - (self.num_pseudo_slices - 1) // 2
+            # slices past the edges of the volume are left as zeros
+            start = max(first_idx, 0)
+            stop = min(first_idx + self.num_pseudo_slices, x_vol.shape[1])
+            x_arr[:, start - first_idx:stop - first_idx] = x_vol[:, start:stop]
             return (x_arr, center_y)
-
-    def get_slice_idx_str(self, case_fpath):
-        """
-        Gets the slice idx and processes it so that it fits how the arrays
-        were saved by `io.Preprocessor.save_dir_as_2d`.
-        """
-        # extracting slice:
-        temp_p = np.random.uniform(0, 1)
-        if temp_p < self.p_pos_per_sample:
-            slice_idx = self.get_rand_pos_slice_idx(case_fpath)
-        else:
-            slice_idx = self.get_rand_slice_idx(case_fpath)
-        slice_idx_str = self._parse_slice_idx_to_str(slice_idx)
-        return (slice_idx_str, slice_idx)
@@ -1,7 +1,9 @@
 import os
-from os.path import join, isdir
+from os.path import join, isdir, isfile
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from tqdm import tqdm
 import nibabel as nib
 import numpy as np
@@ -62,25 +64,92 @@ class Preprocessor(object):
             os.mkdir(out_dir)
             print("Created directory: {0}".format(out_dir))
 
-    def gen_data(self):
+    def gen_data(self, num_workers=None, overwrite=False):
         """
         Generates and saves preprocessed data
         Args:
-            task_path: file path to the task directory (must have the corresponding "dataset.json" in it)
+            num_workers (int): number of processes that preprocess cases in
+                parallel. Defaults to None for half of the CPU cores.
+            overwrite (bool): whether or not to redo cases that were already
+                preprocessed with the same parameters. Defaults to False
+                (they are skipped).
         Returns:
             preprocessed input image and mask
         """
+        if num_workers is None:
+            num_workers = max(1, os.cpu_count() // 2)
         # Generating data and saving them recursively
-        for case in tqdm(self.cases):
-            x_path, y_path = join(case, "imaging.nii.gz"), join(case, "segmentation.nii.gz")
-            image = nib.load(x_path).get_fdata()[None]
-            label = nib.load(y_path).get_fdata()[None] if self.with_mask \
-                    else None
-            preprocessed_img, preprocessed_label = self.preprocess(image,
-                                                                   label,
-                                                                   case)
+        gen_case = partial(self.gen_case, overwrite=overwrite)
+        if num_workers == 1:
+            for case in tqdm(self.cases):
+                gen_case(case)
+        else:
+            # cases are independent, so they are preprocessed in parallel
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                list(tqdm(executor.map(gen_case, self.cases),
+                          total=len(self.cases)))
+
+    def gen_case(self, case, overwrite=False):
+        """
+        Loads, preprocesses and saves a single case.
+        Args:
+            case: path to a case folder (each element of self.cases)
+            overwrite (bool): whether or not to redo the case if it was
+                already preprocessed with the same parameters
+        """
+        if not overwrite and self.is_preprocessed(case):
+            return
+        x_path, y_path = join(case, "imaging.nii.gz"), join(case, "segmentation.nii.gz")
+        # loading as float32/uint8 instead of the default float64
+        image = nib.load(x_path).get_fdata(dtype=np.float32)[None]
+        label = np.asanyarray(nib.load(y_path).dataobj).astype(np.uint8)[None] \
+                if self.with_mask else None
+        preprocessed_img, preprocessed_label = self.preprocess(image,
+                                                               label,
+                                                               case)
+
+        self.save_imgs(preprocessed_img, preprocessed_label, case)
+        self._save_preprocess_params(case)
+
+    def is_preprocessed(self, case):
+        """
+        Checks if `case` was already preprocessed into `out_dir` with the
+        current clipping and resampling parameters.
+        Args:
+            case: path to a case folder (each element of self.cases)
+        Returns:
+            bool
+        """
+        out_case_dir = join(self.out_dir, Path(case).name)
+        params_path = join(out_case_dir, "preprocess_params.json")
+        out_files = ["imaging.npy", "segmentation.npy"] if self.with_mask \
+                    else ["imaging.npy"]
+        if not isfile(params_path) or \
+           not all(isfile(join(out_case_dir, f)) for f in out_files):
+            return False
+        with open(params_path, "r") as fp:
+            return json.load(fp) == self._get_preprocess_params()
 
-            self.save_imgs(preprocessed_img, preprocessed_label, case)
+    def _get_preprocess_params(self):
+        """
+        Parameters that the preprocessed arrays depend on. They are saved with
+        each case, so that unchanged cases can be skipped on reruns.
+        """
+        clip_values = list(self.clip_values) if self.clip_values is not None \
+                      else None
+        return {"clip_values": clip_values,
+                "target_spacing": self.target_spacing.tolist(),
+                "with_mask": self.with_mask}
+
+    def _save_preprocess_params(self, case):
+        """
+        Saves the preprocessing parameters of `case` as
+        preprocess_params.json in its output case folder.
+        """
+        params_path = join(self.out_dir, Path(case).name,
+                           "preprocess_params.json")
+        with open(params_path, "w") as fp:
+            json.dump(self._get_preprocess_params(), fp)
 
     def preprocess(self, image, mask, case=None):
         """
@@ -108,7 +177,11 @@ class Preprocessor(object):
             image, mask = resample_patient(image, mask, np.array(orig_spacing),
                                            target_spacing=self.target_spacing)
         if self.clip_values is not None:
-            image = np.clip(image, self.clip_values[0], self.clip_values[1])
+            # clipping straight into a float32 buffer, so the clip and the
+            # cast happen in the same pass over the volume
+            image = np.clip(image, self.clip_values[0], self.clip_values[1],
+                            out=np.empty(image.shape, dtype=np.float32),
+                            casting="same_kind")
 
         mask = mask[None] if mask is not None else mask
         return (image[None], mask)
@@ -136,15 +209,19 @@ class Preprocessor(object):
 
     def save_dir_as_2d(self):
         """
-        Takes preprocessed 3D numpy arrays and saves them as slices
-        in the same directory.
+        Takes preprocessed 3D numpy arrays and logs their foreground slice
+        indices for 2D training. The slices are not saved as separate files;
+        the 2D datasets read them straight out of the (memory-mapped) 3D
+        arrays.
         """
         self.pos_slice_dict = {}
         # Generating data and saving them recursively
         for case in tqdm(self.cases):
             # assumes the .npy files have shape: (n_channels, d, h, w)
-            image = np.load(join(case, "imaging.npy"))
-            label = np.load(join(case, "segmentation.npy"))
+            # memory-mapped, since the image is only read if it needs to be
+            # saved to a different out_dir
+            image = np.load(join(case, "imaging.npy"), mmap_mode="r")
+            label = np.load(join(case, "segmentation.npy"), mmap_mode="r")
             image = image.squeeze(axis=0) if len(image.shape)==5 else image
             label = label.squeeze(axis=0) if len(label.shape)==5 else label
 
@@ -153,8 +230,9 @@ class Preprocessor(object):
 
     def save_3d_as_2d(self, image, mask, case):
         """
-        Saves an image and mask pair as .npy arrays in the
-        KiTS19 file structure
+        Logs the foreground slice indices of an image and mask pair and makes
+        sure that the pair is saved as .npy arrays in the KiTS19 file
+        structure in `out_dir`, so it can be sliced by the 2D datasets.
         Args:
             image: numpy array
             mask: numpy array
@@ -163,35 +241,29 @@ class Preprocessor(object):
         # saving the generated dataset
         # output dir in KiTS19 format
         # extracting the raw case folder name
+        in_case_dir = case
         case = Path(case).name
         out_case_dir = join(self.out_dir, case)
         # checking to make sure that the output directories exist
         if not isdir(out_case_dir):
             os.mkdir(out_case_dir)
+        # whole volumes instead of one file per slice; nothing to write when
+        # the arrays were read from out_dir in the first place
+        if Path(in_case_dir).resolve() != Path(out_case_dir).resolve():
+            np.save(join(out_case_dir, "imaging.npy"), image)
+            np.save(join(out_case_dir, "segmentation.npy"), mask)
 
-        # iterates through all slices and saves them individually as 2D arrays
         fg_indices = defaultdict(list)
         if mask.shape[1] <= 1:
             print("WARNING: Please double check your mask shape;",
                   f"Masks have shape {mask.shape} when it should be",
                   "shape (n_channels, d, h, w)")
             raise Exception("Please fix shapes.")
-        for slice_idx in range(mask.shape[1]):
-            label_slice = mask[:, slice_idx]
-            # appending fg slice indices
-            for idx in self.fg_classes:
-                if (label_slice == idx).any():
-                    fg_indices[idx].append(slice_idx)
-            # naming convention: {type of slice}_{case}_{slice_idx}
-            slice_idx_str = str(slice_idx)
-            # adding 0s to slice_idx until it reaches 3 digits,
-            # so sorting files is easier when stacking
-            while len(slice_idx_str) < 3:
-                slice_idx_str = "0"+slice_idx_str
-            np.save(join(out_case_dir, f"imaging_{slice_idx_str}.npy"),
-                    image[:, slice_idx])
-            np.save(join(out_case_dir, f"segmentation_{slice_idx_str}.npy"),
-                    label_slice)
+        # fg slice indices for each class in one pass over the mask
+        for idx in self.fg_classes:
+            slice_has_class = (mask == idx).any(axis=(0, 2, 3))
+            if slice_has_class.any():
+                fg_indices[idx] = np.flatnonzero(slice_has_class).tolist()
         # {case1: [idx1, idx2,...], case2: ...}
         self.pos_slice_dict[case] = fg_indices
 
@@ -18,7 +18,22 @@ from scipy.ndimage.filters import gaussian_filter
 from torch import nn
 import torch
 
-from kits19cnn.utils import flip, to_cuda, maybe_to_torch
+from kits19cnn.utils import to_cuda, maybe_to_torch, supports_mixed_precision
+
+def regions_to_segmentation(softmax_pred, regions_class_order):
+    """
+    Converts region probabilities (c, ...) to a label map in a single pass. Where several regions are above 0.5, the
+    one that comes last in regions_class_order wins; voxels not in any region are background (0).
+    :param softmax_pred: numpy array, one channel per region
+    :param regions_class_order: labels for the first len(regions_class_order) channels
+    :return: float32 segmentation of shape softmax_pred.shape[1:]
+    """
+    num_regions = len(regions_class_order)
+    mask = softmax_pred[:num_regions] > 0.5
+    # argmax returns the first True, so search the reversed regions to get the last one
+    last_region = num_regions - 1 - mask[::-1].argmax(0)
+    labels = np.asarray(regions_class_order, dtype=np.float32)
+    return np.where(mask.any(0), labels[last_region], np.float32(0))
 
 class NeuralNetwork(nn.Module):
     def __init__(self):
@@ -47,12 +62,46 @@ class SegmentationNetwork(NeuralNetwork):
         self.num_classes = None
         super(NeuralNetwork, self).__init__()
         self.inference_apply_nonlin = lambda x: x
+        self._tile_weights_2D = None
+        self._tile_weights_2D_key = None
+        self._freeze_forward = False
+        self._frozen_forward = None
+
+    def freeze_for_inference(self):
+        """
+        Makes the predict methods run a TorchScript traced and frozen copy of the network (batchnorm folded into the
+        convolutions, weights inlined as constants) instead of the eager forward. The copy is traced with the first
+        batch that is predicted, so only use this when the input shape stays fixed (tiled prediction).
+        """
+        self._freeze_forward = True
+        self._frozen_forward = None
+
+    def _inference_forward(self, x):
+        # getattr because wrapped smp models do not run SegmentationNetwork.__init__
+        if not getattr(self, "_freeze_forward", False):
+            return self(x)
+        if self._frozen_forward is None:
+            self.eval()
+            frozen = torch.jit.freeze(torch.jit.trace(self, x))
+            # bypasses nn.Module.__setattr__ so that the frozen copy isn't registered as a submodule
+            object.__setattr__(self, "_frozen_forward", frozen)
+        return self._frozen_forward(x)
+
+    def _check_mixed_precision(self, mixed_precision):
+        """
+        Falls back to fp32 prediction when the GPU has no tensor cores.
+        """
+        if mixed_precision and not supports_mixed_precision(self.get_device()):
+            print("Mixed precision needs a GPU with compute capability >= 7.0, so predicting in fp32.")
+            return False
+        return mixed_precision
 
     def predict_3D(self, x, do_mirroring: bool, num_repeats=1,
                    use_train_mode=False, batch_size=1, mirror_axes=(0, 1, 2),
                    tiled=False, tile_in_z=True, step=2, patch_size=None,
                    regions_class_order=None, use_gaussian=False,
-                   pad_border_mode="edge", pad_kwargs=None, all_in_gpu=False):
+                   pad_border_mode="edge", pad_kwargs=None, all_in_gpu=False,
+                   tile_batch_size=16, mixed_precision=False):
         """
         :param x: (c, x, y , z)
         :param do_mirroring: whether or not to do test time data augmentation by mirroring
@@ -71,6 +120,10 @@ class SegmentationNetwork(NeuralNetwork):
         :param use_gaussian: set this to True to prevent stitching artifacts
         :param all_in_gpu: only affects _internal_predict_3D_3Dconv_tiled, _internal_predict_3D_2Dconv_tiled, _internal_predict_3D_2Dconv,
         _internal_predict_2D_2Dconv_tiled
+        :param tile_batch_size: how many 2D tiles (whole slices if not tiled) are predicted per forward pass (2D
+        networks only). With do_mirroring, each forward pass holds tile_batch_size * number of mirrored views inputs
+        :param mixed_precision: run the network in fp16 autocast. Only used on GPUs with tensor cores (compute
+        capability >= 7.0); the predictions are still accumulated in fp32
         :return:
         """
         print("debug: mirroring", do_mirroring, "mirror_axes", mirror_axes)
@@ -88,28 +141,32 @@ class SegmentationNetwork(NeuralNetwork):
         else:
             pass
         assert len(x.shape) == 4, "data must have shape (c,x,y,z)"
-        if self.conv_op == nn.Conv3d:
-            if tiled:
-                res = self._internal_predict_3D_3Dconv_tiled(x, num_repeats, batch_size, tile_in_z, step, do_mirroring,
-                                                             mirror_axes, patch_size, regions_class_order, use_gaussian,
-                                                             pad_border_mode, pad_kwargs=pad_kwargs,
-                                                             all_in_gpu=all_in_gpu)
-            else:
-                res = self._internal_predict_3D_3Dconv(x, do_mirroring, num_repeats, patch_size, batch_size,
-                                                       mirror_axes, regions_class_order, pad_border_mode,
-                                                       pad_kwargs=pad_kwargs)
-        elif self.conv_op == nn.Conv2d:
-            if tiled:
-                res = self._internal_predict_3D_2Dconv_tiled(x, do_mirroring, num_repeats, batch_size, mirror_axes,
-                                                             step, patch_size, regions_class_order, use_gaussian,
-                                                             pad_border_mode, pad_kwargs=pad_kwargs,
-                                                             all_in_gpu=all_in_gpu)
+        mixed_precision = self._check_mixed_precision(mixed_precision)
+        with torch.autocast("cuda", enabled=mixed_precision):
+            if self.conv_op == nn.Conv3d:
+                if tiled:
+                    res = self._internal_predict_3D_3Dconv_tiled(x, num_repeats, batch_size, tile_in_z, step,
+                                                                 do_mirroring, mirror_axes, patch_size,
+                                                                 regions_class_order, use_gaussian, pad_border_mode,
+                                                                 pad_kwargs=pad_kwargs, all_in_gpu=all_in_gpu)
+                else:
+                    res = self._internal_predict_3D_3Dconv(x, do_mirroring, num_repeats, patch_size, batch_size,
+                                                           mirror_axes, regions_class_order, pad_border_mode,
+                                                           pad_kwargs=pad_kwargs)
+            elif self.conv_op == nn.Conv2d:
+                if tiled:
+                    res = self._internal_predict_3D_2Dconv_tiled(x, do_mirroring, num_repeats, batch_size,
+                                                                 mirror_axes, step, patch_size, regions_class_order,
+                                                                 use_gaussian, pad_border_mode, pad_kwargs=pad_kwargs,
+                                                                 all_in_gpu=all_in_gpu,
+                                                                 tile_batch_size=tile_batch_size)
+                else:
+                    res = self._internal_predict_3D_2Dconv(x, do_mirroring, num_repeats, patch_size, batch_size,
+                                                           mirror_axes, regions_class_order, pad_border_mode,
+                                                           pad_kwargs=pad_kwargs, all_in_gpu=all_in_gpu,
+                                                           tile_batch_size=tile_batch_size)
             else:
-                res = self._internal_predict_3D_2Dconv(x, do_mirroring, num_repeats, patch_size, batch_size,
-                                                       mirror_axes, regions_class_order, pad_border_mode,
-                                                       pad_kwargs=pad_kwargs, all_in_gpu=all_in_gpu)
-        else:
-            raise RuntimeError("Invalid conv op, cannot determine what dimensionality (2d/3d) the network is")
+                raise RuntimeError("Invalid conv op, cannot determine what dimensionality (2d/3d) the network is")
         if use_train_mode is not None:
             self.train(current_mode)
         return res
@@ -118,7 +175,7 @@ class SegmentationNetwork(NeuralNetwork):
                    batch_size=1, mirror_axes=(0, 1), tiled=False, step=2,
                    patch_size=None, regions_class_order=None,
                    use_gaussian=False, pad_border_mode="edge", pad_kwargs=None,
-                   all_in_gpu=False):
+                   all_in_gpu=False, tile_batch_size=16, mixed_precision=False):
         assert self.get_device() != "cpu", "CPU not implemented"
 
         if len(mirror_axes) > 0 and max(mirror_axes) > 1:
@@ -131,19 +188,23 @@ class SegmentationNetwork(NeuralNetwork):
             self.eval()
         else:
             pass
-        if self.conv_op == nn.Conv3d:
-            raise RuntimeError("Cannot predict 2d if the network is 3d. Dummy.")
-        elif self.conv_op == nn.Conv2d:
-            if tiled:
-                res = self._internal_predict_2D_2Dconv_tiled(x, num_repeats, batch_size, step, do_mirroring,
-                                                             mirror_axes, patch_size, regions_class_order,
-                                                             use_gaussian, pad_border_mode, pad_kwargs=pad_kwargs,
-                                                             all_in_gpu=all_in_gpu)
+        mixed_precision = self._check_mixed_precision(mixed_precision)
+        with torch.autocast("cuda", enabled=mixed_precision):
+            if self.conv_op == nn.Conv3d:
+                raise RuntimeError("Cannot predict 2d if the network is 3d. Dummy.")
+            elif self.conv_op == nn.Conv2d:
+                if tiled:
+                    res = self._internal_predict_2D_2Dconv_tiled(x, num_repeats, batch_size, step, do_mirroring,
+                                                                 mirror_axes, patch_size, regions_class_order,
+                                                                 use_gaussian, pad_border_mode, pad_kwargs=pad_kwargs,
+                                                                 all_in_gpu=all_in_gpu,
+                                                                 tile_batch_size=tile_batch_size)
+                else:
+                    res = self._internal_predict_2D_2Dconv(x, do_mirroring, num_repeats, None, batch_size,
+                                                           mirror_axes, regions_class_order, pad_border_mode,
+                                                           pad_kwargs=pad_kwargs)
             else:
-                res = self._internal_predict_2D_2Dconv(x, do_mirroring, num_repeats, None, batch_size, mirror_axes,
-                                                       regions_class_order, pad_border_mode, pad_kwargs=pad_kwargs)
-        else:
-            raise RuntimeError("Invalid conv op, cannot determine what dimensionality (2d/3d) the network is")
+                raise RuntimeError("Invalid conv op, cannot determine what dimensionality (2d/3d) the network is")
         if use_train_mode is not None:
             self.train(current_mode)
         return res
@@ -179,14 +240,15 @@ class SegmentationNetwork(NeuralNetwork):
 
         torch.cuda.empty_cache()
 
-        with torch.no_grad():
+        with torch.inference_mode():
             assert patch_size is not None, "patch_size cannot be None for tiled prediction"
 
             data, slicer = pad_nd_image(x, patch_size, pad_border_mode, pad_kwargs, True, None)
 
             data = data[None]
 
-            if BATCH_SIZE is not None:
+            # np.vstack copies the whole volume, even for a single repeat
+            if BATCH_SIZE is not None and BATCH_SIZE > 1:
                 data = np.vstack([data] * BATCH_SIZE)
 
             input_size = [1, x.shape[0]] + list(patch_size)
@@ -230,13 +292,14 @@ class SegmentationNetwork(NeuralNetwork):
                 # some of these can remain in half. We just need the reuslts for softmax so it won't hurt at all to reduce
                 # precision. Inference is of course done in float
                 result = torch.zeros([nb_of_classes] + list(data.shape[2:]), dtype=torch.half).cuda()
-                data = torch.from_numpy(data).cuda(self.get_device())
-                result_numsamples = torch.zeros([nb_of_classes] + list(data.shape[2:]), dtype=torch.half).cuda()
+                data = to_cuda(maybe_to_torch(data), gpu_id=self.get_device())
+                # the weights are the same for every class, so they are only summed up once per voxel
+                result_numsamples = torch.zeros(list(data.shape[2:]), dtype=torch.half).cuda()
                 add = torch.from_numpy(add).cuda(self.get_device()).float()
                 add_torch = add
             else:
                 result = np.zeros([nb_of_classes] + list(data.shape[2:]), dtype=np.float32)
-                result_numsamples = np.zeros([nb_of_classes] + list(data.shape[2:]), dtype=np.float32)
+                result_numsamples = np.zeros(list(data.shape[2:]), dtype=np.float32)
                 add_torch = torch.from_numpy(add).cuda(self.get_device(), non_blocking=True)
 
             # data, result and add_torch and result_numsamples are now on GPU
@@ -261,14 +324,14 @@ class SegmentationNetwork(NeuralNetwork):
                         result[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += predicted_patch
 
                         if all_in_gpu:
-                            result_numsamples[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += add.half()
+                            result_numsamples[lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += add.half()
                         else:
-                            result_numsamples[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += add
+                            result_numsamples[lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += add
 
             slicer = tuple(
                 [slice(0, result.shape[i]) for i in range(len(result.shape) - (len(slicer) - 1))] + slicer[1:])
             result = result[slicer]
-            result_numsamples = result_numsamples[slicer]
+            result_numsamples = result_numsamples[slicer[1:]]
 
             softmax_pred = result / result_numsamples
 
@@ -280,13 +343,11 @@ class SegmentationNetwork(NeuralNetwork):
                     softmax_pred_here = softmax_pred.detach().cpu().numpy()
                 else:
                     softmax_pred_here = softmax_pred
-                predicted_segmentation_shp = softmax_pred_here[0].shape
-                predicted_segmentation = np.zeros(predicted_segmentation_shp, dtype=np.float32)
-                for i, c in enumerate(regions_class_order):
-                    predicted_segmentation[softmax_pred_here[i] > 0.5] = c
+                predicted_segmentation = regions_to_segmentation(softmax_pred_here, regions_class_order)
 
             if all_in_gpu:
-                predicted_segmentation = predicted_segmentation.detach().cpu().numpy()
+                if regions_class_order is None:
+                    predicted_segmentation = predicted_segmentation.detach().cpu().numpy()
                 softmax_pred = softmax_pred.half().detach().cpu().numpy()
         return predicted_segmentation, None, softmax_pred, None
 
@@ -296,44 +357,11 @@ class SegmentationNetwork(NeuralNetwork):
                                     regions_class_order=None,
                                     pad_border_mode="edge",
                                     pad_kwargs=None):
-        with torch.no_grad():
-            _ = None
-            # x, old_shape = pad_patient_2D_incl_c(x, self.input_shape_must_be_divisible_by, min_size)
-            x, slicer = pad_nd_image(x, min_size, pad_border_mode, pad_kwargs, True,
-                                     self.input_shape_must_be_divisible_by)
-            """pad_res = []
-            for i in range(x.shape[0]):
-                t, old_shape = pad_patient_2D(x[i], self.input_shape_must_be_divisible_by, None)
-                pad_res.append(t[None])
-            x = np.vstack(pad_res)"""
-
-            new_shp = x.shape
-
-            data = np.zeros(tuple([1] + list(new_shp)), dtype=np.float32)
-
-            data[0] = x
-
-            if BATCH_SIZE is not None:
-                data = np.vstack([data] * BATCH_SIZE)
-
-            result = self._internal_maybe_mirror_and_pred_2D(data, num_repeats,
-                                                             mirror_axes,
-                                                             do_mirroring)[0]
-
-            slicer = tuple(
-                [slice(0, result.shape[i]) for i in range(len(result.shape) - (len(slicer) - 1))] + slicer[1:])
-            result = result[slicer]
-            softmax_pred = result
-
-            if regions_class_order is None:
-                predicted_segmentation = softmax_pred.argmax(0)
-            else:
-                predicted_segmentation_shp = softmax_pred[0].shape
-                predicted_segmentation = np.zeros(predicted_segmentation_shp,
-                                                  dtype=np.float32)
-                for i, c in enumerate(regions_class_order):
-                    predicted_segmentation[softmax_pred[i] > 0.5] = c
-        return predicted_segmentation, _, softmax_pred, _
+        # a single slice is just a volume with one slice
+        predicted_segmentation, _, softmax_pred, _ = \
+            self._internal_predict_slices_2Dconv(x[:, None], do_mirroring, num_repeats, min_size, mirror_axes,
+                                                 regions_class_order, pad_border_mode, pad_kwargs)
+        return predicted_segmentation[0], None, softmax_pred[:, 0], None
 
     def _internal_predict_3D_3Dconv(self, x, do_mirroring, num_repeats,
                                     min_size=None, BATCH_SIZE=None,
@@ -341,24 +369,20 @@ class SegmentationNetwork(NeuralNetwork):
                                     regions_class_order=None,
                                     pad_border_mode="edge",
                                     pad_kwargs=None):
-        with torch.no_grad():
+        with torch.inference_mode():
             x, slicer = pad_nd_image(x, min_size, pad_border_mode, pad_kwargs, True,
                                      self.input_shape_must_be_divisible_by)
             # x, old_shape = pad_patient_3D_incl_c(x, self.input_shape_must_be_divisible_by, min_size)
 
-            new_shp = x.shape
-
-            data = np.zeros(tuple([1] + list(new_shp)), dtype=np.float32)
+            data = x[None]
 
-            data[0] = x
-
-            if BATCH_SIZE is not None:
+            if BATCH_SIZE is not None and BATCH_SIZE > 1:
                 data = np.vstack([data] * BATCH_SIZE)
 
             stacked = self._internal_maybe_mirror_and_pred_3D(data, num_repeats,
                                                               mirror_axes,
                                                               do_mirroring,
-                                                              None)[0]
+                                                              None)[0].cpu().numpy()
 
             slicer = tuple(
                 [slice(0, stacked.shape[i]) for i in range(len(stacked.shape) - (len(slicer) - 1))] + slicer[1:])
@@ -368,62 +392,44 @@ class SegmentationNetwork(NeuralNetwork):
             if regions_class_order is None:
                 predicted_segmentation = softmax_pred.argmax(0)
             else:
-                predicted_segmentation_shp = softmax_pred[0].shape
-                predicted_segmentation = np.zeros(predicted_segmentation_shp, dtype=np.float32)
-                for i, c in enumerate(regions_class_order):
-                    predicted_segmentation[softmax_pred[i] > 0.5] = c
+                predicted_segmentation = regions_to_segmentation(softmax_pred, regions_class_order)
         return predicted_segmentation, None, softmax_pred, None
 
     def _internal_maybe_mirror_and_pred_3D(self, x, num_repeats, mirror_axes,
                                            do_mirroring=True, mult=None):
         # everything in here takes place on the GPU. If x and mult are not yet on GPU this will be taken care of here
         # we now return a cuda tensor! Not numpy array!
-        with torch.no_grad():
+        with torch.inference_mode():
             x = to_cuda(maybe_to_torch(x), gpu_id=self.get_device())
             result_torch = torch.zeros([1, self.num_classes] + list(x.shape[2:]),
                                        dtype=torch.float).cuda(self.get_device(), non_blocking=True)
-            mult = to_cuda(maybe_to_torch(mult), gpu_id=self.get_device())
+            if mult is not None:
+                mult = to_cuda(maybe_to_torch(mult), gpu_id=self.get_device())
 
-            num_results = num_repeats
+            # axes to flip for each mirrored view; torch.flip makes a single copy per view, whatever the number of axes
+            flip_axes = [()]
             if do_mirroring:
-                mirror_idx = 8
-                num_results *= 2 ** len(mirror_axes)
-            else:
-                mirror_idx = 1
+                if 2 in mirror_axes:
+                    flip_axes.append((4,))
+                if 1 in mirror_axes:
+                    flip_axes.append((3,))
+                if (2 in mirror_axes) and (1 in mirror_axes):
+                    flip_axes.append((4, 3))
+                if 0 in mirror_axes:
+                    flip_axes.append((2,))
+                if (0 in mirror_axes) and (2 in mirror_axes):
+                    flip_axes.append((4, 2))
+                if (0 in mirror_axes) and (1 in mirror_axes):
+                    flip_axes.append((3, 2))
+                if (0 in mirror_axes) and (1 in mirror_axes) and (2 in mirror_axes):
+                    flip_axes.append((3, 2, 4))
+            num_results = num_repeats * len(flip_axes)
 
             for i in range(num_repeats):
-                for m in range(mirror_idx):
-                    if m == 0:
-                        pred = self.inference_apply_nonlin(self(x))
-                        result_torch += 1 / num_results * pred
-
-                    if m == 1 and (2 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(x, 4)))
-                        result_torch += 1 / num_results * flip(pred, 4)
-
-                    if m == 2 and (1 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(x, 3)))
-                        result_torch += 1 / num_results * flip(pred, 3)
-
-                    if m == 3 and (2 in mirror_axes) and (1 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(flip(x, 4), 3)))
-                        result_torch += 1 / num_results * flip(flip(pred, 4), 3)
-
-                    if m == 4 and (0 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(x, 2)))
-                        result_torch += 1 / num_results * flip(pred, 2)
-
-                    if m == 5 and (0 in mirror_axes) and (2 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(flip(x, 4), 2)))
-                        result_torch += 1 / num_results * flip(flip(pred, 4), 2)
-
-                    if m == 6 and (0 in mirror_axes) and (1 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(flip(x, 3), 2)))
-                        result_torch += 1 / num_results * flip(flip(pred, 3), 2)
-
-                    if m == 7 and (0 in mirror_axes) and (1 in mirror_axes) and (2 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(flip(flip(x, 3), 2), 4)))
-                        result_torch += 1 / num_results * flip(flip(flip(pred, 3), 2), 4)
+                for axes in flip_axes:
+                    x_mirrored = torch.flip(x, axes) if axes else x
+                    pred = self.inference_apply_nonlin(self._inference_forward(x_mirrored))
+                    result_torch.add_(torch.flip(pred, axes) if axes else pred, alpha=1 / num_results)
 
             if mult is not None:
                 result_torch[:, :] *= mult
@@ -434,39 +440,33 @@ class SegmentationNetwork(NeuralNetwork):
                                            do_mirroring=True, mult=None):
         # everything in here takes place on the GPU. If x and mult are not yet on GPU this will be taken care of here
         # we now return a cuda tensor! Not numpy array!
-        with torch.no_grad():
+        with torch.inference_mode():
             x = to_cuda(maybe_to_torch(x), gpu_id=self.get_device())
-            mult = to_cuda(maybe_to_torch(mult), gpu_id=self.get_device())
-            result_torch = torch.zeros([1, self.num_classes] + list(x.shape[2:]),
+            if mult is not None:
+                mult = to_cuda(maybe_to_torch(mult), gpu_id=self.get_device())
+            result_torch = torch.zeros([x.shape[0], self.num_classes] + list(x.shape[2:]),
                                        dtype=torch.float).cuda(self.get_device(), non_blocking=True)
 
-            num_results = num_repeats
+            # axes to flip for each mirrored view; all views go through the network in a single forward pass
+            flip_axes = [()]
             if do_mirroring:
-                mirror_idx = 4
-                num_results *= 2 ** len(mirror_axes)
-            else:
-                mirror_idx = 1
-
-            for i in range(num_repeats):
-                for m in range(mirror_idx):
-                    if m == 0:
-                        pred = self.inference_apply_nonlin(self(x))
-                        result_torch += 1 / num_results * pred
+                if 1 in mirror_axes:
+                    flip_axes.append((3,))
+                if 0 in mirror_axes:
+                    flip_axes.append((2,))
+                if (0 in mirror_axes) and (1 in mirror_axes):
+                    flip_axes.append((3, 2))
+            num_results = num_repeats * len(flip_axes)
 
-                    if m == 1 and (1 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(x, 3)))
-                        result_torch += 1 / num_results * flip(pred, 3)
+            mirrored = torch.cat([torch.flip(x, axes) if axes else x for axes in flip_axes])
 
-                    if m == 2 and (0 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(x, 2)))
-                        result_torch += 1 / num_results * flip(pred, 2)
-
-                    if m == 3 and (0 in mirror_axes) and (1 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(flip(x, 3), 2)))
-                        result_torch += 1 / num_results * flip(flip(pred, 3), 2)
+            for i in range(num_repeats):
+                preds = self.inference_apply_nonlin(self._inference_forward(mirrored)).split(x.shape[0])
+                for pred, axes in zip(preds, flip_axes):
+                    result_torch.add_(torch.flip(pred, axes) if axes else pred, alpha=1 / num_results)
 
-        if mult is not None:
-            result_torch[:, :] *= mult
+            if mult is not None:
+                result_torch[:, :] *= mult
 
         return result_torch
 
@@ -478,25 +478,99 @@ class SegmentationNetwork(NeuralNetwork):
                                           use_gaussian=False,
                                           pad_border_mode="edge",
                                           pad_kwargs=None,
-                                          all_in_gpu=False):
-        with torch.no_grad():
-            tile_size = patch_size
-            assert tile_size is not None, "patch_size cannot be None for tiled prediction"
-            # pad images so that their size is a multiple of tile_size
-            data, slicer = pad_nd_image(patient_data, tile_size, pad_border_mode, pad_kwargs, True)
+                                          all_in_gpu=False,
+                                          tile_batch_size=16):
+        # a single slice is just a volume with one slice
+        predicted_segmentation, _, softmax_pred, _ = \
+            self._internal_predict_3D_2Dconv_tiled(patient_data[:, None], do_mirroring, num_repeats, BATCH_SIZE,
+                                                   mirror_axes, step, patch_size, regions_class_order, use_gaussian,
+                                                   pad_border_mode, pad_kwargs=pad_kwargs, all_in_gpu=all_in_gpu,
+                                                   tile_batch_size=tile_batch_size)
+        return predicted_segmentation[0], None, softmax_pred[:, 0], None
 
-            data = data[None]
+    def _internal_predict_3D_2Dconv(self, data, do_mirroring, num_repeats,
+                                    min_size=None, BATCH_SIZE=None,
+                                    mirror_axes=(0, 1),
+                                    regions_class_order=None,
+                                    pad_border_mode="edge",
+                                    pad_kwargs=None,
+                                    all_in_gpu=False,
+                                    tile_batch_size=16):
+        if all_in_gpu:
+            raise NotImplementedError
+        assert len(data.shape) == 4, "data must be c, x, y, z"
+        return self._internal_predict_slices_2Dconv(data, do_mirroring, num_repeats, min_size, mirror_axes,
+                                                    regions_class_order, pad_border_mode, pad_kwargs,
+                                                    tile_batch_size)
 
-            if BATCH_SIZE is not None:
-                data = np.vstack([data] * BATCH_SIZE)
+    def predict_3D_pseudo3D_2Dconv(self, data, do_mirroring, num_repeats,
+                                   min_size=None, BATCH_SIZE=None,
+                                   mirror_axes=(0, 1),
+                                   regions_class_order=None, pseudo3D_slices=5,
+                                   all_in_gpu=False, mixed_precision=False,
+                                   tile_batch_size=16):
+        if all_in_gpu:
+            raise NotImplementedError
+        assert len(data.shape) == 4, "data must be c, x, y, z"
+        assert pseudo3D_slices % 2 == 1, "pseudo3D_slices must be odd"
+        extra_slices = (pseudo3D_slices - 1) // 2
+        shp_for_pad = np.array(data.shape)
+        shp_for_pad[1] = extra_slices
+        pad = np.zeros(shp_for_pad, dtype=np.float32)
+        data = np.concatenate((pad, data, pad), 1)
+        mixed_precision = self._check_mixed_precision(mixed_precision)
+        with torch.autocast("cuda", enabled=mixed_precision):
+            res = self._internal_predict_slices_2Dconv(data, do_mirroring, num_repeats, min_size, mirror_axes,
+                                                       regions_class_order, slice_batch_size=tile_batch_size,
+                                                       pseudo3D_slices=pseudo3D_slices)
+        return res
 
-            input_size = [1, patient_data.shape[0]] + list(tile_size)
-            input_size = [int(i) for i in input_size]
-            a = torch.zeros(input_size, dtype=torch.float).cuda(self.get_device(), non_blocking=True)
+    def _internal_predict_slices_2Dconv(self, data, do_mirroring, num_repeats,
+                                        min_size=None, mirror_axes=(0, 1),
+                                        regions_class_order=None,
+                                        pad_border_mode="edge",
+                                        pad_kwargs=None,
+                                        slice_batch_size=16,
+                                        pseudo3D_slices=1):
+        """
+        Fully convolutional prediction of all slices along x of data, which
+        must be (c, x, y, z). The slices are padded once and predicted
+        `slice_batch_size` at a time.
+        :param pseudo3D_slices: if > 1, each slice is predicted with its neighbours stacked along the channel axis. data
+        must then already contain (pseudo3D_slices - 1) // 2 extra slices on either side
+        :return:
+        """
+        with torch.inference_mode():
+            data, slicer = pad_nd_image(data, min_size, pad_border_mode, pad_kwargs, True,
+                                        self.input_shape_must_be_divisible_by)
+            # the whole volume goes to the GPU once; batches are then sliced from it there
+            data = to_cuda(maybe_to_torch(data), gpu_id=self.get_device())
+            num_slices = data.shape[1] - (pseudo3D_slices - 1)
+
+            softmax_pred = np.zeros([self.num_classes, num_slices] + list(data.shape[2:]), dtype=np.float32)
+            for batch_start in range(0, num_slices, slice_batch_size):
+                batch_slices = range(batch_start, min(batch_start + slice_batch_size, num_slices))
+                batch = torch.stack([data[:, s:s + pseudo3D_slices].reshape((-1,) + tuple(data.shape[2:]))
+                                     for s in batch_slices])
+                pred = self._internal_maybe_mirror_and_pred_2D(batch, num_repeats, mirror_axes, do_mirroring)
+                softmax_pred[:, batch_slices.start:batch_slices.stop] = pred.cpu().numpy().transpose((1, 0, 2, 3))
+
+            softmax_pred = softmax_pred[tuple([slice(0, softmax_pred.shape[0]), slice(0, num_slices)] + slicer[2:])]
 
-            # dummy run to see number of classes
-            nb_of_classes = self(a).size()[1]
+            if regions_class_order is None:
+                predicted_segmentation = softmax_pred.argmax(0)
+            else:
+                predicted_segmentation = regions_to_segmentation(softmax_pred, regions_class_order)
+        return predicted_segmentation, None, softmax_pred, None
 
+    def _get_tile_weights_2D(self, tile_size, use_gaussian=False):
+        """
+        Weights of each pixel of a tile when the tiles are averaged: a gaussian importance map or just ones. These
+        only depend on the tile size, so they are cached between predictions.
+        """
+        key = (tuple(tile_size), use_gaussian)
+        # getattr because wrapped smp models do not run SegmentationNetwork.__init__
+        if getattr(self, "_tile_weights_2D_key", None) != key:
             if use_gaussian:
                 tmp = np.zeros(tile_size, dtype=np.float32)
                 center_coords = [i // 2 for i in tile_size]
@@ -507,8 +581,46 @@ class SegmentationNetwork(NeuralNetwork):
                 add = tmp_smooth
             else:
                 add = np.ones(tile_size, dtype=np.float32)
+            self._tile_weights_2D = add.astype(np.float32)
+            self._tile_weights_2D_key = key
+        return self._tile_weights_2D
 
-            add = add.astype(np.float32)
+    def _internal_predict_3D_2Dconv_tiled(self, data, do_mirroring,
+                                          num_repeats, BATCH_SIZE=None,
+                                          mirror_axes=(0, 1),
+                                          step=2, patch_size=None,
+                                          regions_class_order=None,
+                                          use_gaussian=False,
+                                          pad_border_mode="edge",
+                                          pad_kwargs=None, all_in_gpu=False,
+                                          tile_batch_size=16):
+        """
+        data must be (c, x, y, z); the 2D tiles of all slices along x are
+        gathered and predicted `tile_batch_size` at a time instead of one by
+        one.
+        :param BATCH_SIZE: unused; tiles are batched with tile_batch_size
+        :param tile_batch_size: number of tiles per forward pass
+        :return:
+        """
+        assert len(data.shape) == 4, "data must be c, x, y, z"
+        with torch.inference_mode():
+            tile_size = patch_size
+            assert tile_size is not None, "patch_size cannot be None for tiled prediction"
+            # pad all slices at once so that they are at least tile_size. pad_nd_image returns data itself (no copy)
+            # when the slices are already large enough, which is the usual case; when they are not, every tile overlaps
+            # the border anyway, so padding per tile would not copy less
+            data, slicer = pad_nd_image(data, tile_size, pad_border_mode, pad_kwargs, True)
+            # the whole volume goes to the GPU once; the tiles are then gathered from it there
+            data = to_cuda(maybe_to_torch(data), gpu_id=self.get_device())
+
+            input_size = [1, data.shape[0]] + list(tile_size)
+            input_size = [int(i) for i in input_size]
+            a = torch.zeros(input_size, dtype=torch.float).cuda(self.get_device(), non_blocking=True)
+
+            # dummy run to see number of classes
+            nb_of_classes = self(a).size()[1]
+
+            add = self._get_tile_weights_2D(tile_size, use_gaussian)
 
             data_shape = data.shape
             center_coord_start = np.array([i // 2 for i in patch_size]).astype(int)
@@ -522,49 +634,58 @@ class SegmentationNetwork(NeuralNetwork):
             xsteps = np.round(np.arange(center_coord_start[0], center_coord_end[0] + 1e-8, step_size[0])).astype(int)
             ysteps = np.round(np.arange(center_coord_start[1], center_coord_end[1] + 1e-8, step_size[1])).astype(int)
 
+            # lower bounds of the tiles and the actual tile shape (patch_size // 2 on either side of the center)
+            lb_xs = xsteps - patch_size[0] // 2
+            lb_ys = ysteps - patch_size[1] // 2
+            tile_shape = [2 * (i // 2) for i in patch_size]
+            # (slice, lb_x, lb_y) of every tile in the volume
+            tile_s, tile_x, tile_y = [torch.from_numpy(i.ravel()) for i in
+                                      np.meshgrid(np.arange(data_shape[1]), lb_xs, lb_ys, indexing="ij")]
+
             if all_in_gpu:
-                # some of these can remain in half. We just need the reuslts for softmax so it won't hurt at all to reduce
-                # precision. Inference is of course done in float
-                result = torch.zeros([nb_of_classes] + list(data.shape[2:]), dtype=torch.half).cuda()
-                data = torch.from_numpy(data).cuda(self.get_device())
-                result_numsamples = torch.zeros([nb_of_classes] + list(data.shape[2:]), dtype=torch.half).cuda()
+                # the accumulators stay in float: the corners of the gaussian weights underflow in half. Only the
+                # returned softmax is converted to half
+                result = torch.zeros([data_shape[1], nb_of_classes] + list(data_shape[2:]), dtype=torch.float).cuda()
+                result_numsamples = torch.zeros(list(data_shape[2:]), dtype=torch.float).cuda()
                 add = torch.from_numpy(add).cuda(self.get_device()).float()
                 add_torch = add
             else:
-                result = np.zeros([nb_of_classes] + list(data.shape[2:]), dtype=np.float32)
-                result_numsamples = np.zeros([nb_of_classes] + list(data.shape[2:]), dtype=np.float32)
+                # slice-major (slice, c, x, y), so that all classes of a tile land in one contiguous block and
+                # consecutive tiles (which come from the same slice) keep hitting the same memory
+                result = np.zeros([data_shape[1], nb_of_classes] + list(data_shape[2:]), dtype=np.float32)
+                result_numsamples = np.zeros(list(data_shape[2:]), dtype=np.float32)
                 add_torch = torch.from_numpy(add).cuda(self.get_device(), non_blocking=True)
 
-            for x in xsteps:
-                lb_x = x - patch_size[0] // 2
-                ub_x = x + patch_size[0] // 2
-                for y in ysteps:
-                    lb_y = y - patch_size[1] // 2
-                    ub_y = y + patch_size[1] // 2
-                    predicted_patch = \
-                        self._internal_maybe_mirror_and_pred_2D(data[:, :, lb_x:ub_x, lb_y:ub_y],
-                                                                num_repeats,
-                                                                mirror_axes,
-                                                                do_mirroring,
-                                                                add_torch)[0]
-                    if all_in_gpu:
-                        predicted_patch = predicted_patch.half()
-                    else:
-                        predicted_patch = predicted_patch.cpu().numpy()
-
-                    result[:, lb_x:ub_x, lb_y:ub_y] += predicted_patch
-
-                    if all_in_gpu:
-                        result_numsamples[:, lb_x:ub_x, lb_y:ub_y] += add.half()
-                    else:
-                        result_numsamples[:, lb_x:ub_x, lb_y:ub_y] += add
-
-            slicer = tuple(
-                [slice(0, result.shape[i]) for i in range(len(result.shape) - (len(slicer) - 1))] + slicer[1:])
-            result = result[slicer]
-            result_numsamples = result_numsamples[slicer]
-
-            softmax_pred = result / result_numsamples
+            # every slice is tiled the same way, so the weights only need to be summed up once
+            for lb_x in lb_xs:
+                for lb_y in lb_ys:
+                    result_numsamples[lb_x:lb_x + tile_shape[0], lb_y:lb_y + tile_shape[1]] += add
+
+            # view of every possible tile: (c, slice, lb_x, lb_y, tile_x, tile_y); indexing it gathers a whole batch
+            windows = data.unfold(2, tile_shape[0], 1).unfold(3, tile_shape[1], 1)
+            tile_s_gpu, tile_x_gpu, tile_y_gpu = to_cuda([tile_s, tile_x, tile_y], gpu_id=self.get_device())
+            for batch_start in range(0, len(tile_s), tile_batch_size):
+                batch_idx = slice(batch_start, batch_start + tile_batch_size)
+                batch_s, batch_x, batch_y = tile_s[batch_idx], tile_x[batch_idx], tile_y[batch_idx]
+                batch = windows[:, tile_s_gpu[batch_idx], tile_x_gpu[batch_idx], tile_y_gpu[batch_idx]]
+                predicted_patches = self._internal_maybe_mirror_and_pred_2D(batch.transpose(0, 1), num_repeats,
+                                                                            mirror_axes, do_mirroring, add_torch)
+                if not all_in_gpu:
+                    predicted_patches = predicted_patches.cpu().numpy()
+
+                for s, lb_x, lb_y, predicted_patch in zip(batch_s.tolist(), batch_x.tolist(), batch_y.tolist(),
+                                                          predicted_patches):
+                    result[s, :, lb_x:lb_x + tile_shape[0], lb_y:lb_y + tile_shape[1]] += predicted_patch
+
+            result = result[(slicer[1], slice(None), slicer[2], slicer[3])]
+            result_numsamples = result_numsamples[tuple(slicer[2:])]
+
+            # back to (c, x, y, z); the transpose is folded into the division
+            if all_in_gpu:
+                softmax_pred = (result.transpose(0, 1) / result_numsamples).contiguous()
+            else:
+                softmax_pred = np.empty((result.shape[1], result.shape[0]) + result.shape[2:], dtype=np.float32)
+                np.divide(result.transpose((1, 0, 2, 3)), result_numsamples, out=softmax_pred)
 
             if regions_class_order is None:
                 predicted_segmentation = softmax_pred.argmax(0)
@@ -573,93 +694,10 @@ class SegmentationNetwork(NeuralNetwork):
                     softmax_pred_here = softmax_pred.detach().cpu().numpy()
                 else:
                     softmax_pred_here = softmax_pred
-                predicted_segmentation_shp = softmax_pred_here[0].shape
-                predicted_segmentation = np.zeros(predicted_segmentation_shp,
-                                                  dtype=np.float32)
-                for i, c in enumerate(regions_class_order):
-                    predicted_segmentation[softmax_pred_here[i] > 0.5] = c
+                predicted_segmentation = regions_to_segmentation(softmax_pred_here, regions_class_order)
 
             if all_in_gpu:
-                predicted_segmentation = predicted_segmentation.detach().cpu().numpy()
+                if regions_class_order is None:
+                    predicted_segmentation = predicted_segmentation.detach().cpu().numpy()
                 softmax_pred = softmax_pred.half().detach().cpu().numpy()
         return predicted_segmentation, None, softmax_pred, None
-
-    def _internal_predict_3D_2Dconv(self, data, do_mirroring, num_repeats,
-                                    min_size=None, BATCH_SIZE=None,
-                                    mirror_axes=(0, 1),
-                                    regions_class_order=None,
-                                    pad_border_mode="edge",
-                                    pad_kwargs=None,
-                                    all_in_gpu=False):
-        if all_in_gpu:
-            raise NotImplementedError
-        assert len(data.shape) == 4, "data must be c, x, y, z"
-        predicted_segmentation = []
-        softmax_pred = []
-        for s in range(data.shape[1]):
-            pred_seg, bayesian_predictions, softmax_pres, uncertainty = \
-                self._internal_predict_2D_2Dconv(data[:, s], do_mirroring,
-                                                 num_repeats, min_size,
-                                                 BATCH_SIZE, mirror_axes,
-                                                 regions_class_order,
-                                                 pad_border_mode, pad_kwargs)
-            predicted_segmentation.append(pred_seg[None])
-            softmax_pred.append(softmax_pres[None])
-        predicted_segmentation = np.vstack(predicted_segmentation)
-        softmax_pred = np.vstack(softmax_pred).transpose((1, 0, 2, 3))
-        return predicted_segmentation, None, softmax_pred, None
-
-    def predict_3D_pseudo3D_2Dconv(self, data, do_mirroring, num_repeats,
-                                   min_size=None, BATCH_SIZE=None,
-                                   mirror_axes=(0, 1),
-                                   regions_class_order=None, pseudo3D_slices=5,
-                                   all_in_gpu=False):
-        if all_in_gpu:
-            raise NotImplementedError
-        assert len(data.shape) == 4, "data must be c, x, y, z"
-        assert pseudo3D_slices % 2 == 1, "pseudo3D_slices must be odd"
-        extra_slices = (pseudo3D_slices - 1) // 2
-        shp_for_pad = np.array(data.shape)
-        shp_for_pad[1] = extra_slices
-        pad = np.zeros(shp_for_pad, dtype=np.float32)
-        data = np.concatenate((pad, data, pad), 1)
-        predicted_segmentation = []
-        softmax_pred = []
-        for s in range(extra_slices, data.shape[1] - extra_slices):
-            d = data[:, (s - extra_slices):(s + extra_slices + 1)]
-            d = d.reshape((-1, d.shape[-2], d.shape[-1]))
-            pred_seg, bayesian_predictions, softmax_pres, uncertainty = \
-                self._internal_predict_2D_2Dconv(d, do_mirroring, num_repeats,
-                                                 min_size, BATCH_SIZE,
-                                                 mirror_axes,
-                                                 regions_class_order)
-            predicted_segmentation.append(pred_seg[None])
-            softmax_pred.append(softmax_pres[None])
-        predicted_segmentation = np.vstack(predicted_segmentation)
-        softmax_pred = np.vstack(softmax_pred).transpose((1, 0, 2, 3))
-
-        return predicted_segmentation, None, softmax_pred, None
-
-    def _internal_predict_3D_2Dconv_tiled(self, data, do_mirroring,
-                                          num_repeats, BATCH_SIZE=None,
-                                          mirror_axes=(0, 1),
-                                          step=2, patch_size=None,
-                                          regions_class_order=None,
-                                          use_gaussian=False,
-                                          pad_border_mode="edge",
-                                          pad_kwargs=None, all_in_gpu=False):
-        if all_in_gpu:
-            raise NotImplementedError
-        assert len(data.shape) == 4, "data must be c, x, y, z"
-        predicted_segmentation = []
-        softmax_pred = []
-        for s in range(data.shape[1]):
-            pred_seg, bayesian_predictions, softmax_pres, uncertainty = \
-                self._internal_predict_2D_2Dconv_tiled(data[:, s], num_repeats, BATCH_SIZE, step, do_mirroring,
-                                                       mirror_axes, patch_size, regions_class_order, use_gaussian,
-                                                       pad_border_mode=pad_border_mode, pad_kwargs=pad_kwargs)
-            predicted_segmentation.append(pred_seg[None])
-            softmax_pred.append(softmax_pres[None])
-        predicted_segmentation = np.vstack(predicted_segmentation)
-        softmax_pred = np.vstack(softmax_pred).transpose((1, 0, 2, 3))
-        return predicted_segmentation, None, softmax_pred, None
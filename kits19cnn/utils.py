@@ -51,6 +51,17 @@ def to_cuda(data, non_blocking=True, gpu_id=0):
         data = data.cuda(gpu_id, non_blocking=True)
     return data
 
+def supports_mixed_precision(gpu_id=0):
+    """
+    Checks if the GPU has tensor cores (compute capability >= 7.0), which is
+    where fp16 inference actually pays off.
+    :param gpu_id:
+    :return:
+    """
+    if not torch.cuda.is_available():
+        return False
+    return torch.cuda.get_device_capability(gpu_id)[0] >= 7
+
 def softmax_helper(x):
     rpt = [1 for _ in range(len(x.size()))]
     rpt[1] = x.size(1)
@@ -38,7 +38,8 @@ def main(config):
                      checkpoint_path=config["checkpoint_path"],
                      model=exp.model, test_loader=exp.loaders["test"],
                      pred_3D_params=config["predict_3D_params"],
-                     pseudo_3D=config.get("pseudo_3D"))
+                     pseudo_3D=config.get("pseudo_3D"),
+                     freeze_model=config.get("freeze_model", False))
     pred.run_3D_predictions()
 
 if __name__ == "__main__":
@@ -19,7 +19,7 @@ setup(name='kits19cnn',
             "pandas",
             "sklearn",
             "batchgenerators",
-            "torch>=1.2.0",
+            "torch>=1.10.0",
             "torchvision>=0.4.0",
             "catalyst",
             "pytorch_toolbelt",